@@ -12,7 +12,8 @@ autofill patient name & ward when HN is provided.
 - Designed for hospital LAN: bind to 0.0.0.0 and keep token/auth behind LAN.
 
 Run:
-  python p_porter_app.py  # starts Flask on :5005 (LAN)
+  python p_porter_app.py  # starts the API on :5005 (LAN); served by waitress
+                          # with PPORTER_THREADS worker threads when installed
 
 Demo (separate shell):
   python demo_client.py   # calls the API with `requests` to show end‑to‑end
@@ -20,14 +21,26 @@ Demo (separate shell):
 NOTE: This file is self‑contained; SQLite files are created in the working dir.
 """
 from __future__ import annotations
-import os, sqlite3, json
+import os, sys, json, atexit, sqlite3, threading, queue, logging, logging.handlers
 from datetime import datetime, date, time
-from typing import Dict, Any, Optional, Tuple
+from contextlib import contextmanager
+from pathlib import Path
+from time import monotonic
+from typing import Dict, Any, Iterator, Optional, Tuple
 
-from flask import Flask, jsonify, request, abort
+from flask import Flask, jsonify, request, abort, has_request_context
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson  # optional: C encoder, UTF-8 output
+except ImportError:
+    orjson = None
 
 APP_PORT = int(os.getenv("PPORTER_PORT", "5005"))
 DB_PATH   = os.getenv("PPORTER_DB", "p_porter.db")
+APP_THREADS = int(os.getenv("PPORTER_THREADS", "8"))
+DB_POOL_SIZE = int(os.getenv("PPORTER_DB_POOL", str(APP_THREADS)))  # ≥ threads: no connect churn
+DB_MMAP_SIZE = int(os.getenv("PPORTER_DB_MMAP", str(64 * 1024 * 1024)))  # 0 disables
 
 # Optional integration with Registry app's LocalDBLogger outputs
 SCHEDULE_DB_PATHS = [
@@ -35,6 +48,12 @@ SCHEDULE_DB_PATHS = [
     os.getenv("REGISTRY_SCHEDULE_EMERGENCY", "schedule_emergency.db"),
 ]
 
+SCHEDULE_CACHE_TTL = float(os.getenv("PPORTER_SCHEDULE_TTL", "300"))  # seconds; 0 disables
+SCHEDULE_CACHE_MAX = 1024
+
+LOG_LEVEL = os.getenv("PPORTER_LOG_LEVEL", "INFO")  # WARNING silences mock notifications
+log = logging.getLogger("pporter")
+
 # ---- Proximity map (lower is nearer to OR Area) ----
 PROXIMITY_TO_OR: Dict[str, int] = {
     "OR Area": 0,
@@ -57,143 +76,394 @@ WEEKDAY_AM_SHIFT = {
     "end":   time(16, 0),
 }
 
+# ---- Logging ----
+
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(level: str = LOG_LEVEL) -> logging.handlers.QueueListener:
+    """Request threads only enqueue log records; a listener thread does the
+    formatting and the (possibly slow, console) stdout write. Runs at import,
+    so `waitress-serve p_porter:app` and tests get the notifications too;
+    calling it again only changes the level."""
+    global _log_listener
+    log.setLevel(level.upper())
+    if _log_listener is None:
+        q: queue.SimpleQueue = queue.SimpleQueue()
+        _log_listener = logging.handlers.QueueListener(q, logging.StreamHandler(sys.stdout))
+        log.addHandler(logging.handlers.QueueHandler(q))
+        log.propagate = False
+        _log_listener.start()
+        atexit.register(_log_listener.stop)  # drain queued records on exit
+    return _log_listener
+
+
+setup_logging()
+
+
 # ---- Flask ----
+
+class PorterJSONProvider(DefaultJSONProvider):
+    """Serializes sqlite3.Row directly (endpoints can jsonify fetchall()
+    without a dict copy per row) and uses orjson when it is installed."""
+
+    @staticmethod
+    def default(o: Any) -> Any:
+        if isinstance(o, sqlite3.Row):
+            return dict(o)
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_SORT_KEYS if self.sort_keys else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = PorterJSONProvider(app)
+# API clients don't care about key order or whitespace: skip the per-response
+# key sort and never pretty-print.
+app.json.sort_keys = False
+app.json.compact = True
+# Thai names/wards as UTF-8, not \uXXXX escapes, on the stdlib path too
+# (orjson always emits UTF-8).
+app.json.ensure_ascii = False
 
 # ---- DB helpers ----
 
-def get_db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+# Long-lived connections, reused LIFO so the most recently used one (with the
+# warmest page cache) is handed out first. Borrow with `with get_db() as conn`
+# (read/write) or `with get_read_db() as conn` (query_only, for pure-read
+# endpoints); leaving the block — normally or via an exception/abort() — rolls
+# back any open transaction and returns the connection. Under WAL the read
+# pool never waits on a writer.
+class PooledConnection(sqlite3.Connection):
+    pool: list["PooledConnection"]  # where release_db() returns it
+
+
+_POOL: list[PooledConnection] = []
+_READ_POOL: list[PooledConnection] = []
+_POOL_LOCK = threading.Lock()
+
+# Resolved once so every pooled connection opens the same file even if the
+# working directory changes after startup.
+_DB_CONN_PATH = os.path.abspath(DB_PATH)
+
+
+def _init_connection(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """One-time per-connection setup; only runs when the pool grows."""
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")  # safe with WAL (see init_db)
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    return conn
+
+
+def _borrow(pool: list[PooledConnection], readonly: bool) -> PooledConnection:
+    with _POOL_LOCK:
+        if pool:
+            return pool.pop()
+    conn = sqlite3.connect(_DB_CONN_PATH, check_same_thread=False, factory=PooledConnection)
+    _init_connection(conn)
+    if readonly:
+        conn.execute("PRAGMA query_only=1")
+    conn.pool = pool
     return conn
 
 
+@contextmanager
+def get_db() -> Iterator[PooledConnection]:
+    conn = _borrow(_POOL, readonly=False)
+    try:
+        yield conn
+    finally:
+        release_db(conn)
+
+
+@contextmanager
+def get_read_db() -> Iterator[PooledConnection]:
+    conn = _borrow(_READ_POOL, readonly=True)
+    try:
+        yield conn
+    finally:
+        release_db(conn)
+
+
+def release_db(conn: PooledConnection) -> None:
+    # never hand a half-finished transaction to the next borrower
+    if conn.in_transaction:
+        conn.rollback()
+    with _POOL_LOCK:
+        if len(conn.pool) < DB_POOL_SIZE:
+            conn.pool.append(conn)
+            return
+    conn.close()
+
+
 def init_db() -> None:
-    conn = get_db(); cur = conn.cursor()
-    cur.executescript(
-        """
-        CREATE TABLE IF NOT EXISTS porters(
-            porter_id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            role TEXT,
-            last_area TEXT DEFAULT 'OR Area',
-            status TEXT DEFAULT 'Available', -- Available | Busy
-            last_available_time TEXT
-        );
-
-        CREATE TABLE IF NOT EXISTS porter_stats(
-            porter_id TEXT PRIMARY KEY,
-            tasks_assigned_count INTEGER NOT NULL DEFAULT 0,
-            FOREIGN KEY(porter_id) REFERENCES porters(porter_id)
-        );
-
-        CREATE TABLE IF NOT EXISTS daily_roster(
-            date TEXT NOT NULL,
-            shift TEXT NOT NULL,
-            role TEXT NOT NULL,               -- เปล 1 | เปล 2 | เปล 3
-            porter_id TEXT NOT NULL,
-            PRIMARY KEY(date, shift, role),
-            FOREIGN KEY(porter_id) REFERENCES porters(porter_id)
-        );
-
-        CREATE TABLE IF NOT EXISTS tasks(
-            task_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            hn TEXT,
-            patient_name TEXT,
-            target_ward TEXT,
-            source_area TEXT DEFAULT 'OR Area',
-            task_type TEXT NOT NULL,          -- OR_to_WARD | WARD_to_OR
-            status TEXT NOT NULL,             -- New|Dispatched|Accepted|InProgress|Completed|Cancelled
-            assigned_porter_id TEXT,
-            created_at TEXT,
-            updated_at TEXT,
-            FOREIGN KEY(assigned_porter_id) REFERENCES porters(porter_id)
-        );
-
-        CREATE TABLE IF NOT EXISTS shift_state(
-            date TEXT NOT NULL,
-            shift TEXT NOT NULL,
-            first_job_assigned INTEGER NOT NULL DEFAULT 0,
-            PRIMARY KEY(date, shift)
-        );
-        """
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS porters(
+                porter_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                role TEXT,
+                last_area TEXT DEFAULT 'OR Area',
+                status TEXT DEFAULT 'Available', -- Available | Busy
+                last_available_time TEXT,
+                last_available_epoch INTEGER      -- same instant as epoch seconds (dispatch sort key)
+            );
+
+            CREATE TABLE IF NOT EXISTS porter_stats(
+                porter_id TEXT PRIMARY KEY,
+                tasks_assigned_count INTEGER NOT NULL DEFAULT 0,
+                FOREIGN KEY(porter_id) REFERENCES porters(porter_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS daily_roster(
+                date TEXT NOT NULL,
+                shift TEXT NOT NULL,
+                role TEXT NOT NULL,               -- เปล 1 | เปล 2 | เปล 3
+                porter_id TEXT NOT NULL,
+                PRIMARY KEY(date, shift, role),
+                FOREIGN KEY(porter_id) REFERENCES porters(porter_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS tasks(
+                task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                hn TEXT,
+                patient_name TEXT,
+                target_ward TEXT,
+                source_area TEXT DEFAULT 'OR Area',
+                task_type TEXT NOT NULL,          -- OR_to_WARD | WARD_to_OR
+                status TEXT NOT NULL,             -- New|Dispatched|Accepted|InProgress|Completed|Cancelled
+                assigned_porter_id TEXT,
+                created_at TEXT,
+                updated_at TEXT,
+                FOREIGN KEY(assigned_porter_id) REFERENCES porters(porter_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS shift_state(
+                date TEXT NOT NULL,
+                shift TEXT NOT NULL,
+                first_job_assigned INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY(date, shift)
+            );
+
+            -- monotonic id sequences (porter → Pnn)
+            CREATE TABLE IF NOT EXISTS id_counter(
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+
+            -- covers the dispatcher's roster→porters join without touching roster rows
+            CREATE INDEX IF NOT EXISTS idx_roster_date_shift ON daily_roster(date, shift, porter_id);
+            """
+        )
+        _migrate_db(cur)
+        conn.commit()
+        # WAL is persistent in the DB file: readers (/api/porters, /api/tasks, …)
+        # no longer block on an in-flight dispatch write.
+        cur.execute("PRAGMA journal_mode=WAL").fetchone()
+
+
+def _migrate_db(cur: sqlite3.Cursor) -> None:
+    """Bring DBs created by older versions up to the current schema."""
+    cols = {r["name"] for r in cur.execute("PRAGMA table_info(porters)")}
+    if "last_available_epoch" not in cols:
+        cur.execute("ALTER TABLE porters ADD COLUMN last_available_epoch INTEGER")
+        rows = cur.execute("SELECT porter_id, last_available_time FROM porters").fetchall()
+        cur.executemany(
+            "UPDATE porters SET last_available_epoch=? WHERE porter_id=?",
+            [(int(parse_available_time(r["last_available_time"]).timestamp()), r["porter_id"]) for r in rows],
+        )
+    # start the porter sequence after the highest existing Pnn
+    cur.execute(
+        "INSERT OR IGNORE INTO id_counter(name, value)\n"
+        "SELECT 'porter', IFNULL(MAX(CAST(SUBSTR(porter_id, 2) AS INTEGER)), 0) FROM porters"
     )
-    conn.commit(); conn.close()
+
+
+def _reserve_porter_ids(cur: sqlite3.Cursor, count: int) -> list[str]:
+    """Mint `count` consecutive Pnn ids with one counter-row update (no scan of
+    porters, no lexicographic P99 < P100 trap). Call inside the INSERT's
+    transaction."""
+    cur.execute("UPDATE id_counter SET value = value + ? WHERE name='porter' RETURNING value", (count,))
+    last = cur.fetchone()[0]
+    return [f"P{n:02d}" for n in range(last - count + 1, last + 1)]
+
+
+def _next_porter_id(cur: sqlite3.Cursor) -> str:
+    return _reserve_porter_ids(cur, 1)[0]
 
 
 def seed_porters_if_empty() -> None:
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) AS c FROM porters"); cnt = cur.fetchone()[0]
-    if cnt and cnt > 0:
-        conn.close(); return
-    names = [
-        "นาที", "อนุพันธ์", "กฤษณพงษ์", "จีระวัฒน์",
-        "นัฐพงษ์", "ศราวุธ", "รัตนพล", "อนุพงษ์",
-    ]
-    for i, name in enumerate(names, start=1):
-        pid = f"P{i:02d}"
-        cur.execute(
-            "INSERT INTO porters(porter_id, name, role, last_area, status, last_available_time)\n"
-            "VALUES(?, ?, NULL, 'OR Area', 'Available', ?)",
-            (pid, name, iso_now()),
+    with get_db() as conn:
+        cur = conn.cursor()
+        # count + inserts under one write lock: two processes starting together
+        # cannot both seed
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT COUNT(*) AS c FROM porters"); cnt = cur.fetchone()[0]
+        if cnt and cnt > 0:
+            return
+        names = [
+            "นาที", "อนุพันธ์", "กฤษณพงษ์", "จีระวัฒน์",
+            "นัฐพงษ์", "ศราวุธ", "รัตนพล", "อนุพงษ์",
+        ]
+        ids = _reserve_porter_ids(cur, len(names))
+        now_text, now_epoch = available_now()
+        cur.executemany(
+            "INSERT INTO porters(porter_id, name, role, last_area, status, last_available_time, last_available_epoch)\n"
+            "VALUES(?, ?, NULL, 'OR Area', 'Available', ?, ?)",
+            [(pid, name, now_text, now_epoch) for pid, name in zip(ids, names)],
         )
-        cur.execute(
+        cur.executemany(
             "INSERT OR IGNORE INTO porter_stats(porter_id, tasks_assigned_count) VALUES(?, 0)",
-            (pid,),
+            [(pid,) for pid in ids],
         )
-    conn.commit(); conn.close()
+        conn.commit()
 
 
 # ---- Utils ----
 
+def request_now() -> datetime:
+    """datetime.now(), taken once per request (stashed in the WSGI environ, not
+    on flask.g, which outlives a request inside `with app.app_context()`) so the
+    date/shift helpers below agree and don't re-read the clock."""
+    if not has_request_context():
+        return datetime.now()
+    now = request.environ.get("pporter.now")
+    if now is None:
+        now = request.environ["pporter.now"] = datetime.now()
+    return now
+
+
 def today_str() -> str:
-    return date.today().strftime('%Y-%m-%d')
+    return request_now().date().isoformat()
 
 
 def iso_now() -> str:
-    return datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    """request_now() as ISO text; formatted once per request like the clock."""
+    if not has_request_context():
+        return datetime.now().isoformat(timespec='seconds')
+    text = request.environ.get("pporter.now_iso")
+    if text is None:
+        text = request.environ["pporter.now_iso"] = request_now().isoformat(timespec='seconds')
+    return text
+
+
+def available_now() -> Tuple[str, int]:
+    """Current time as (ISO text, epoch seconds) for porters.last_available_*."""
+    if not has_request_context():
+        now = datetime.now()  # one clock read for both values
+        return now.isoformat(timespec='seconds'), int(now.timestamp())
+    return iso_now(), int(request_now().timestamp())
 
 
 def is_weekday(d: Optional[date] = None) -> bool:
-    d = d or date.today()
+    d = d or request_now().date()
     return d.weekday() < 5  # Mon=0..Fri=4
 
 
+def _minute_of_day(t: time) -> int:
+    return t.hour * 60 + t.minute
+
+
+# 1 for every minute of the day inside the Morning shift (shift bounds are
+# whole minutes), so the check is a single index instead of time compares.
+_MORNING_BY_MINUTE = bytearray(
+    1 if _minute_of_day(WEEKDAY_AM_SHIFT["start"]) <= m < _minute_of_day(WEEKDAY_AM_SHIFT["end"]) else 0
+    for m in range(24 * 60)
+)
+
+
 def in_morning_shift(now: Optional[datetime] = None) -> bool:
-    now = now or datetime.now()
-    return WEEKDAY_AM_SHIFT["start"] <= now.time() < WEEKDAY_AM_SHIFT["end"]
+    now = now or request_now()
+    return bool(_MORNING_BY_MINUTE[now.hour * 60 + now.minute])
+
+
+_EPOCH = datetime(1970, 1, 1)
 
 
-def proximity_score(area: Optional[str]) -> int:
-    if not area:
-        return DEFAULT_PROXIMITY
-    return PROXIMITY_TO_OR.get(area, DEFAULT_PROXIMITY)
+def parse_available_time(value: Optional[str]) -> datetime:
+    """Parse a stored last_available_time; missing/garbled → very old.
+    Only used to backfill last_available_epoch on older DBs."""
+    if not value:
+        return _EPOCH
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return _EPOCH
 
 
 # ---- Integration: lookup patient from schedule DBs (optional) ----
 
+_SCHEDULE_CONNS: Dict[str, Tuple[sqlite3.Connection, threading.Lock]] = {}
+_SCHEDULE_CONNS_LOCK = threading.Lock()
+
+
+def _schedule_conn(path: str) -> Tuple[sqlite3.Connection, threading.Lock]:
+    """Long-lived read-only connection per schedule DB (opened on first use)."""
+    entry = _SCHEDULE_CONNS.get(path)
+    if entry is None:
+        with _SCHEDULE_CONNS_LOCK:
+            entry = _SCHEDULE_CONNS.get(path)
+            if entry is None:
+                uri = Path(path).absolute().as_uri() + "?mode=ro"
+                c = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                c.row_factory = sqlite3.Row
+                c.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+                entry = _SCHEDULE_CONNS[path] = (c, threading.Lock())
+    return entry
+
+
+# Most recent entry for today, else latest on any day — one statement.
+SQL_SCHEDULE_LATEST = (
+    "SELECT name, ward, date FROM schedule WHERE hn=?\n"
+    "ORDER BY date=? DESC, id DESC LIMIT 1"
+)
+
+
+# (hn, date) → (expires_at, (name, ward)); hits only, so a patient the registry
+# adds after a miss is picked up on the next request.
+_SCHEDULE_CACHE: Dict[Tuple[str, str], Tuple[float, Tuple[Optional[str], Optional[str]]]] = {}
+_SCHEDULE_CACHE_LOCK = threading.Lock()
+
+
 def lookup_patient_from_schedule(hn: str) -> Tuple[Optional[str], Optional[str]]:
     if not hn:
         return (None, None)
+    key = (hn, today_str())
+    hit = _SCHEDULE_CACHE.get(key)
+    if hit is not None and hit[0] > monotonic():
+        return hit[1]
+    found = _lookup_schedule_dbs(hn, key[1])
+    if found != (None, None) and SCHEDULE_CACHE_TTL > 0:
+        with _SCHEDULE_CACHE_LOCK:
+            if len(_SCHEDULE_CACHE) >= SCHEDULE_CACHE_MAX:
+                del _SCHEDULE_CACHE[next(iter(_SCHEDULE_CACHE))]  # oldest insert
+            _SCHEDULE_CACHE[key] = (monotonic() + SCHEDULE_CACHE_TTL, found)
+    return found
+
+
+def _lookup_schedule_dbs(hn: str, today: str) -> Tuple[Optional[str], Optional[str]]:
     for path in SCHEDULE_DB_PATHS:
-        if not path or not os.path.exists(path):
+        # stat only until the DB has been opened once; the registry may
+        # create its schedule files after we start
+        if path not in _SCHEDULE_CONNS and not (path and os.path.exists(path)):
             continue
         try:
-            c = sqlite3.connect(path); c.row_factory = sqlite3.Row
-            cur = c.cursor()
-            # Try to get the most recent for today; fallback to latest any day
-            cur.execute(
-                "SELECT name, ward, date FROM schedule WHERE hn=? AND date=? ORDER BY id DESC LIMIT 1",
-                (hn, today_str()),
-            )
-            row = cur.fetchone()
-            if not row:
-                cur.execute(
-                    "SELECT name, ward, date FROM schedule WHERE hn=? ORDER BY id DESC LIMIT 1",
-                    (hn,),
-                )
-                row = cur.fetchone()
-            c.close()
+            c, lock = _schedule_conn(path)
+            with lock:
+                row = c.execute(SQL_SCHEDULE_LATEST, (hn, today)).fetchone()
             if row:
                 return (row["name"], row["ward"])  # may be None
         except Exception:
@@ -203,6 +473,53 @@ def lookup_patient_from_schedule(hn: str) -> Tuple[Optional[str], Optional[str]]
 
 # ---- Dispatcher ----
 
+def _proximity_case_sql(column: str) -> str:
+    """PROXIMITY_TO_OR as a SQL CASE over `column` (built once at import)."""
+    whens = " ".join(
+        "WHEN '{}' THEN {:d}".format(area.replace("'", "''"), score)
+        for area, score in PROXIMITY_TO_OR.items()
+    )
+    return f"CASE {column} {whens} ELSE {DEFAULT_PROXIMITY:d} END"
+
+
+# Fairness ranking done by SQLite: only the winner comes back. Fixed statement
+# text (no per-call IN (?,?,…) building) so sqlite3's statement cache serves
+# it on every dispatch.
+SQL_PICK_FAIREST = f"""
+    SELECT p.porter_id, p.name
+      FROM daily_roster r
+      JOIN porters p ON p.porter_id = r.porter_id
+      LEFT JOIN porter_stats s ON s.porter_id = p.porter_id
+     WHERE r.date=? AND r.shift=? AND p.status='Available'
+     ORDER BY COALESCE(s.tasks_assigned_count,0),
+              COALESCE(p.last_available_epoch,0),
+              {_proximity_case_sql("p.last_area")},
+              p.porter_id
+     LIMIT 1
+"""
+# Weekday-morning rule in one lookup: the porter rostered in `role`, only if
+# still Available and the shift's first job hasn't gone out yet.
+SQL_FIRST_JOB_PORTER = """
+    SELECT p.porter_id, p.name
+      FROM daily_roster r
+      JOIN porters p ON p.porter_id = r.porter_id
+     WHERE r.date=? AND r.shift=? AND r.role=? AND p.status='Available'
+       AND NOT EXISTS (SELECT 1 FROM shift_state ss
+                        WHERE ss.date = r.date AND ss.shift = r.shift
+                          AND ss.first_job_assigned)
+"""
+SQL_ROSTER_EXISTS = "SELECT 1 FROM daily_roster WHERE date=? AND shift=? LIMIT 1"
+SQL_MARK_FIRST_JOB = (
+    "INSERT INTO shift_state(date,shift,first_job_assigned)\n"
+    "VALUES(?,?,1) ON CONFLICT(date,shift) DO UPDATE SET first_job_assigned=1"
+)
+SQL_ASSIGN_TASK = "UPDATE tasks SET assigned_porter_id=?, status='Dispatched', updated_at=? WHERE task_id=?"
+SQL_BUMP_ASSIGNED = (
+    "INSERT INTO porter_stats(porter_id, tasks_assigned_count)\n"
+    "VALUES(?, 1)\n"
+    "ON CONFLICT(porter_id) DO UPDATE SET tasks_assigned_count = tasks_assigned_count + 1"
+)
+
 def dispatch_or_to_ward(new_task: sqlite3.Row | Dict[str, Any]) -> Dict[str, Any]:
     """Smart dispatcher for OR→WARD (fairness first). Returns result dict.
     Steps:
@@ -212,103 +529,77 @@ def dispatch_or_to_ward(new_task: sqlite3.Row | Dict[str, Any]) -> Dict[str, Any
       4) tie‑1: earliest last_available_time
       5) tie‑2: proximity to OR based on porter's last_area
     """
-    conn = get_db(); cur = conn.cursor()
-
-    # 1) active roster for today/morning only (spec requirement mentions Morning)
+    with get_db() as conn:
+        cur = conn.cursor()
+        # One write transaction from candidate read to commit: a concurrent
+        # dispatch cannot pick from stale counts, and the UPDATE/UPSERT/shift_state
+        # writes land in a single commit.
+        cur.execute("BEGIN IMMEDIATE")
+        result = _assign_in_tx(cur, new_task)
+        conn.commit()
+    _notify_dispatch(new_task, result)
+    return result
+
+
+def _assign_in_tx(cur: sqlite3.Cursor, new_task: sqlite3.Row | Dict[str, Any]) -> Dict[str, Any]:
+    """Dispatcher steps 1‑5 on `cur`, which must already hold BEGIN IMMEDIATE.
+    Writes the assignment but leaves the commit to the caller."""
+    # 1) active roster for today/morning only (spec requirement mentions Morning);
+    #    both lookups below join daily_roster themselves.
     today = today_str()
-    cur.execute(
-        "SELECT role, porter_id FROM daily_roster WHERE date=? AND shift=?",
-        (today, WEEKDAY_AM_SHIFT["name"]),
-    )
-    roster = {r["role"]: r["porter_id"] for r in cur.fetchall()}
-    if not roster:
-        conn.close()
-        return {"ok": False, "reason": "Roster not set for today"}
-
-    rostered_ids = list(roster.values())
-    if not rostered_ids:
-        conn.close(); return {"ok": False, "reason": "No rostered porters"}
-    placeholders = ",".join(["?"] * len(rostered_ids))
-    q = f"""
-    SELECT p.porter_id, p.name, p.role, p.last_area, p.status, p.last_available_time,
-           COALESCE(s.tasks_assigned_count,0) AS cnt
-      FROM porters p
-      LEFT JOIN porter_stats s ON s.porter_id = p.porter_id
-     WHERE p.porter_id IN ({placeholders}) AND p.status='Available'
-    """
-    cur.execute(q, rostered_ids)
-    candidates = [dict(row) for row in cur.fetchall()]
-    if not candidates:
-        conn.close(); return {"ok": False, "reason": "No Available porter"}
+    shift = WEEKDAY_AM_SHIFT["name"]
 
     # 2) special rule: first job on weekday Morning → เปล 3 (if Available)
-    special_taken = False
-    now = datetime.now()
+    chosen = None
+    now = request_now()
     if is_weekday(now.date()) and in_morning_shift(now):
-        cur.execute(
-            "SELECT first_job_assigned FROM shift_state WHERE date=? AND shift=?",
-            (today, WEEKDAY_AM_SHIFT["name"]),
-        )
-        row = cur.fetchone()
-        first_done = bool(row[0]) if row else False
-        if not first_done:
-            # is rostered เปล 3 available?
-            pid_pref = roster.get("เปล 3")
-            if pid_pref:
-                for c in candidates:
-                    if c["porter_id"] == pid_pref:
-                        chosen = c
-                        special_taken = True
-                        break
-                else:
-                    chosen = None
-            else:
-                chosen = None
-            if chosen:
-                # mark first assigned
-                cur.execute(
-                    "INSERT INTO shift_state(date,shift,first_job_assigned)\n"
-                    "VALUES(?,?,1) ON CONFLICT(date,shift) DO UPDATE SET first_job_assigned=1",
-                    (today, WEEKDAY_AM_SHIFT["name"]),
-                )
-            # else: fallthrough to fairness
-    # 3‑5) fairness & tie‑breakers
-    if not special_taken:
-        def key_fn(c: Dict[str, Any]):
-            # Parse last_available_time; missing treated as very old
-            try:
-                ts = datetime.fromisoformat(c.get("last_available_time") or "1970-01-01T00:00:00")
-            except Exception:
-                ts = datetime(1970,1,1)
-            prox = proximity_score(c.get("last_area"))
-            return (int(c.get("cnt", 0)), ts, prox, c.get("porter_id"))
-        candidates.sort(key=key_fn)
-        chosen = candidates[0]
+        cur.execute(SQL_FIRST_JOB_PORTER, (today, shift, "เปล 3"))
+        chosen = cur.fetchone()
+        if chosen:
+            # mark first assigned
+            cur.execute(SQL_MARK_FIRST_JOB, (today, shift))
+        # else: fallthrough to fairness
+    # 3‑5) fairness & tie‑breakers (missing last_available → very old)
+    if not chosen:
+        cur.execute(SQL_PICK_FAIREST, (today, shift))
+        chosen = cur.fetchone()
+        if not chosen:
+            # cold path: tell "no roster" apart from "everyone busy"
+            cur.execute(SQL_ROSTER_EXISTS, (today, shift))
+            reason = "No Available porter" if cur.fetchone() else "Roster not set for today"
+            return {"ok": False, "reason": reason}
 
     # Assign task → update DB
     porter_id = chosen["porter_id"]
-    cur.execute(
-        "UPDATE tasks SET assigned_porter_id=?, status='Dispatched', updated_at=? WHERE task_id=?",
-        (porter_id, iso_now(), new_task["task_id"]),
-    )
-    cur.execute(
-        "INSERT INTO porter_stats(porter_id, tasks_assigned_count)\n"
-        "VALUES(?, 1)\n"
-        "ON CONFLICT(porter_id) DO UPDATE SET tasks_assigned_count = tasks_assigned_count + 1",
-        (porter_id,),
-    )
-    conn.commit(); conn.close()
+    cur.execute(SQL_ASSIGN_TASK, (porter_id, iso_now(), new_task["task_id"]))
+    cur.execute(SQL_BUMP_ASSIGNED, (porter_id,))
+    return {"ok": True, "assigned_porter_id": porter_id, "porter_name": chosen['name']}
 
-    # Mock notifications (console)
-    print(f"[Dispatcher] Assign task#{new_task['task_id']} to {porter_id} ({chosen['name']})")
-    print(f"[Push→Porter] 📲 {chosen['name']} รับเคสใหม่: HN {new_task['hn']} → {new_task['target_ward']}")
-    print(f"[Notify→Ward] 🏥 แจ้งวอร์ด {new_task['target_ward']} ว่ามีเปล {chosen['name']} ไปรับผู้ป่วยจาก OR")
 
-    return {"ok": True, "assigned_porter_id": porter_id, "porter_name": chosen['name']}
+def _notify_dispatch(new_task: sqlite3.Row | Dict[str, Any], result: Dict[str, Any]) -> None:
+    """Mock notifications (console); call only after the assignment committed."""
+    if not result["ok"]:
+        return
+    name = result["porter_name"]
+    log.info("[Dispatcher] Assign task#%s to %s (%s)", new_task["task_id"], result["assigned_porter_id"], name)
+    log.info("[Push→Porter] 📲 %s รับเคสใหม่: HN %s → %s", name, new_task["hn"], new_task["target_ward"])
+    log.info("[Notify→Ward] 🏥 แจ้งวอร์ด %s ว่ามีเปล %s ไปรับผู้ป่วยจาก OR", new_task["target_ward"], name)
 
 
 # ---- API Endpoints ----
 
+SQL_LIST_PORTERS = "SELECT * FROM porters ORDER BY porter_id"
+SQL_ROSTER_BY_ROLE = "SELECT role, porter_id FROM daily_roster WHERE date=? AND shift=? ORDER BY role"
+SQL_INSERT_TASK = (
+    "INSERT INTO tasks(hn,patient_name,target_ward,source_area,task_type,status,assigned_porter_id,created_at,updated_at)\n"
+    "VALUES(?,?,?,?, 'OR_to_WARD', 'New', NULL, ?, ?)"
+)
+SQL_LIST_TASKS = (
+    "SELECT t.*, p.name as porter_name FROM tasks t\n"
+    "LEFT JOIN porters p ON p.porter_id = t.assigned_porter_id\n"
+    "ORDER BY t.task_id DESC LIMIT ? OFFSET ?"
+)
+
 @app.get("/api/health")
 def api_health():
     return jsonify({"ok": True, "time": iso_now()})
@@ -339,10 +630,11 @@ def favicon():
 
 @app.get("/api/porters")
 def api_porters_list():
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM porters ORDER BY porter_id")
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close(); return jsonify(rows)
+    with get_read_db() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_LIST_PORTERS)
+        rows = cur.fetchall()
+    return jsonify(rows)
 
 
 @app.post("/api/porters/add")
@@ -351,18 +643,16 @@ def api_porters_add():
     name = str(payload.get("name") or "").strip()
     if not name:
         abort(400, "name required")
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT porter_id FROM porters ORDER BY porter_id DESC LIMIT 1")
-    row = cur.fetchone()
-    next_num = int(row["porter_id"][1:]) + 1 if row else 1
-    new_id = f"P{next_num:02d}"
-    cur.execute(
-        "INSERT INTO porters(porter_id,name,role,last_area,status,last_available_time)\n"
-        "VALUES(?, ?, NULL, 'OR Area', 'Available', ?)",
-        (new_id, name, iso_now()),
-    )
-    cur.execute("INSERT INTO porter_stats(porter_id,tasks_assigned_count) VALUES(?,0)", (new_id,))
-    conn.commit(); conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        new_id = _next_porter_id(cur)
+        cur.execute(
+            "INSERT INTO porters(porter_id,name,role,last_area,status,last_available_time,last_available_epoch)\n"
+            "VALUES(?, ?, NULL, 'OR Area', 'Available', ?, ?)",
+            (new_id, name, *available_now()),
+        )
+        cur.execute("INSERT INTO porter_stats(porter_id,tasks_assigned_count) VALUES(?,0)", (new_id,))
+        conn.commit()
     return jsonify({"ok": True, "porter_id": new_id, "name": name})
 
 
@@ -377,43 +667,50 @@ def api_roster_set():
         if role not in mapping:
             abort(400, f"missing role: {role}")
     today = today_str()
-    conn = get_db(); cur = conn.cursor()
-
-    # Upsert roster rows & reset roles for everyone
-    cur.execute("UPDATE porters SET role=NULL")
-    for role, pid in mapping.items():
-        cur.execute(
+    shift = WEEKDAY_AM_SHIFT["name"]
+    now_text, now_epoch = available_now()
+    slots = list(mapping.items())
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+
+        # Upsert roster rows & reset roles for everyone (one statement per table)
+        cur.execute("UPDATE porters SET role=NULL WHERE role IS NOT NULL")
+        cur.executemany(
             "INSERT INTO daily_roster(date,shift,role,porter_id) VALUES(?,?,?,?)\n"
             "ON CONFLICT(date,shift,role) DO UPDATE SET porter_id=excluded.porter_id",
-            (today, WEEKDAY_AM_SHIFT["name"], role, pid),
+            [(today, shift, role, pid) for role, pid in slots],
+        )
+        cur.executemany(
+            "UPDATE porters SET role=?, status='Available', last_available_time=?, last_available_epoch=? WHERE porter_id=?",
+            [(role, now_text, now_epoch, pid) for role, pid in slots],
         )
-        cur.execute("UPDATE porters SET role=?, status='Available', last_available_time=? WHERE porter_id=?",
-                    (role, iso_now(), pid))
-        cur.execute("INSERT OR IGNORE INTO porter_stats(porter_id,tasks_assigned_count) VALUES(?,0)", (pid,))
         # Also reset today's counter for fairness
-        cur.execute("UPDATE porter_stats SET tasks_assigned_count=0 WHERE porter_id=?", (pid,))
+        cur.executemany(
+            "INSERT INTO porter_stats(porter_id,tasks_assigned_count) VALUES(?,0)\n"
+            "ON CONFLICT(porter_id) DO UPDATE SET tasks_assigned_count=0",
+            [(pid,) for _, pid in slots],
+        )
 
-    # Mark that first job is NOT yet assigned for the shift
-    cur.execute(
-        "INSERT INTO shift_state(date,shift,first_job_assigned) VALUES(?,?,0)\n"
-        "ON CONFLICT(date,shift) DO UPDATE SET first_job_assigned=0",
-        (today, WEEKDAY_AM_SHIFT["name"]),
-    )
-    conn.commit(); conn.close()
+        # Mark that first job is NOT yet assigned for the shift
+        cur.execute(
+            "INSERT INTO shift_state(date,shift,first_job_assigned) VALUES(?,?,0)\n"
+            "ON CONFLICT(date,shift) DO UPDATE SET first_job_assigned=0",
+            (today, shift),
+        )
+        conn.commit()
 
-    print(f"[Roster] {today} Morning → {json.dumps(mapping, ensure_ascii=False)}")
-    return jsonify({"ok": True, "date": today, "shift": WEEKDAY_AM_SHIFT["name"], "roster": mapping})
+    log.info("[Roster] %s Morning → %s", today, json.dumps(mapping, ensure_ascii=False))
+    return jsonify({"ok": True, "date": today, "shift": shift, "roster": mapping})
 
 
 @app.get("/api/roster/today")
 def api_roster_today():
-    conn = get_db(); cur = conn.cursor()
-    cur.execute(
-        "SELECT role, porter_id FROM daily_roster WHERE date=? AND shift=? ORDER BY role",
-        (today_str(), WEEKDAY_AM_SHIFT["name"]),
-    )
-    data = {r["role"]: r["porter_id"] for r in cur.fetchall()}
-    conn.close(); return jsonify({"date": today_str(), "shift": WEEKDAY_AM_SHIFT["name"], "roster": data})
+    with get_read_db() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_ROSTER_BY_ROLE, (today_str(), WEEKDAY_AM_SHIFT["name"]))
+        data = {r["role"]: r["porter_id"] for r in cur.fetchall()}
+    return jsonify({"date": today_str(), "shift": WEEKDAY_AM_SHIFT["name"], "roster": data})
 
 
 @app.post("/api/request_move")
@@ -437,23 +734,60 @@ def api_request_move():
     if task_type == "OR_to_WARD" and not target_ward:
         abort(400, "target_ward required for OR_to_WARD")
 
-    conn = get_db(); cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO tasks(hn,patient_name,target_ward,source_area,task_type,status,assigned_porter_id,created_at,updated_at)\n"
-        "VALUES(?,?,?,?, 'OR_to_WARD', 'New', NULL, ?, ?)",
-        (hn, patient_name, target_ward or None, 'OR Area', iso_now(), iso_now()),
-    )
-    task_id = cur.lastrowid
-    # fetch fresh row for dispatcher
-    cur.execute("SELECT * FROM tasks WHERE task_id=?", (task_id,))
-    new_task = cur.fetchone()
-    conn.commit(); conn.close()
-
-    # Dispatch (OR→WARD as per spec)
-    result = dispatch_or_to_ward(new_task)
+    with get_db() as conn:
+        cur = conn.cursor()
+        # insert + dispatch share one write transaction (one commit per move);
+        # with no porter free the task still commits as 'New'
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(SQL_INSERT_TASK, (hn, patient_name, target_ward or None, 'OR Area', iso_now(), iso_now()))
+        task_id = cur.lastrowid
+        # the dispatcher only needs what we just inserted — no read-back SELECT
+        new_task = {"task_id": task_id, "hn": hn, "target_ward": target_ward or None}
+
+        # Dispatch (OR→WARD as per spec)
+        result = _assign_in_tx(cur, new_task)
+        conn.commit()
+    _notify_dispatch(new_task, result)
     return jsonify({"task_id": task_id, **result})
 
 
+SQL_ACCEPT_TASK = (
+    "UPDATE tasks SET status='Accepted', updated_at=?\n"
+    "WHERE task_id=? AND assigned_porter_id=? AND status IN ('Dispatched','Accepted')"
+)
+SQL_COMPLETE_TASK = (
+    "UPDATE tasks SET status='Completed', updated_at=?\n"
+    "WHERE task_id=? AND status<>'Completed'\n"
+    "  AND (?='' OR assigned_porter_id IS NULL OR assigned_porter_id=?)\n"
+    "RETURNING assigned_porter_id, target_ward"
+)
+SQL_TASK_STATE = "SELECT assigned_porter_id, status FROM tasks WHERE task_id=?"
+SQL_PORTER_BUSY = "UPDATE porters SET status='Busy' WHERE porter_id=?"
+SQL_FREE_PORTER = (
+    "UPDATE porters SET status='Available', last_area=?, last_available_time=?, last_available_epoch=?\n"
+    "WHERE porter_id=?"
+)
+
+
+def _task_conflict(cur, task_id: int, porter_id: str, strict: bool) -> Tuple[int, str]:
+    """Explain why a task CAS matched nothing (cold path only). Same order as
+    the endpoints always checked: 404, then the assignee check (403), and only
+    then the status (409). `strict` (accept): the caller must be the assignee;
+    otherwise (complete) only a different, known porter is refused."""
+    cur.execute(SQL_TASK_STATE, (task_id,))
+    row = cur.fetchone()
+    if not row:
+        return 404, "task not found"
+    assigned = row["assigned_porter_id"]
+    if strict:
+        not_assignee = assigned != porter_id
+    else:
+        not_assignee = bool(porter_id and assigned and assigned != porter_id)
+    if not_assignee:
+        return 403, "not assignee"
+    return 409, f"task is {row['status']}"
+
+
 @app.post("/api/task/<int:task_id>/accept")
 def api_task_accept(task_id: int):
     payload = request.get_json(force=True) or {}
@@ -461,20 +795,17 @@ def api_task_accept(task_id: int):
     if not porter_id:
         abort(400, "porter_id required")
 
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT assigned_porter_id, status FROM tasks WHERE task_id=?", (task_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close(); abort(404, "task not found")
-    if row["assigned_porter_id"] != porter_id:
-        conn.close(); abort(403, "not assignee")
-
-    # mark Accepted + porter Busy
-    cur.execute("UPDATE tasks SET status='Accepted', updated_at=? WHERE task_id=?", (iso_now(), task_id))
-    cur.execute("UPDATE porters SET status='Busy' WHERE porter_id=?", (porter_id,))
-    conn.commit(); conn.close()
-
-    print(f"[Porter Action] {porter_id} accepted task#{task_id}")
+    with get_db() as conn:
+        cur = conn.cursor()
+        # compare-and-swap: only the assignee of a live task can accept it
+        cur.execute(SQL_ACCEPT_TASK, (iso_now(), task_id, porter_id))
+        if cur.rowcount == 0:
+            code, msg = _task_conflict(cur, task_id, porter_id, strict=True)
+            abort(code, msg)
+        cur.execute(SQL_PORTER_BUSY, (porter_id,))
+        conn.commit()
+
+    log.info("[Porter Action] %s accepted task#%s", porter_id, task_id)
     return jsonify({"ok": True})
 
 
@@ -483,39 +814,36 @@ def api_task_complete(task_id: int):
     payload = request.get_json(force=True) or {}
     porter_id = str(payload.get("porter_id") or "").strip()
 
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT assigned_porter_id, target_ward FROM tasks WHERE task_id=?", (task_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close(); abort(404, "task not found")
-    assigned = row["assigned_porter_id"]
-    target_ward = row["target_ward"]
-    if porter_id and assigned and porter_id != assigned:
-        conn.close(); abort(403, "not assignee")
-
-    # Complete task, free porter, update last_area + last_available_time
-    cur.execute("UPDATE tasks SET status='Completed', updated_at=? WHERE task_id=?", (iso_now(), task_id))
-    if assigned:
-        cur.execute(
-            "UPDATE porters SET status='Available', last_area=?, last_available_time=? WHERE porter_id=?",
-            (target_ward or 'OR Area', iso_now(), assigned),
-        )
-    conn.commit(); conn.close()
-
-    print(f"[Porter Action] {assigned or porter_id or '-'} completed task#{task_id} at {target_ward}")
+    with get_db() as conn:
+        cur = conn.cursor()
+        # compare-and-swap: a task completes once, and only by its assignee
+        cur.execute(SQL_COMPLETE_TASK, (iso_now(), task_id, porter_id, porter_id))
+        row = cur.fetchone()
+        if not row:
+            code, msg = _task_conflict(cur, task_id, porter_id, strict=False)
+            abort(code, msg)
+        assigned = row["assigned_porter_id"]
+        target_ward = row["target_ward"]
+
+        # free porter, update last_area + last_available_time
+        if assigned:
+            cur.execute(SQL_FREE_PORTER, (target_ward or 'OR Area', *available_now(), assigned))
+        conn.commit()
+
+    log.info("[Porter Action] %s completed task#%s at %s", assigned or porter_id or "-", task_id, target_ward)
     return jsonify({"ok": True, "last_area": target_ward})
 
 
 @app.get("/api/tasks")
 def api_tasks_list():
-    conn = get_db(); cur = conn.cursor()
-    cur.execute(
-        "SELECT t.*, p.name as porter_name FROM tasks t\n"
-        "LEFT JOIN porters p ON p.porter_id = t.assigned_porter_id\n"
-        "ORDER BY t.task_id DESC"
-    )
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close(); return jsonify(rows)
+    """Newest first. ?limit=N (default 200, -1 = all) &offset=M"""
+    limit = request.args.get("limit", default=200, type=int)
+    offset = request.args.get("offset", default=0, type=int)
+    with get_read_db() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_LIST_TASKS, (limit, offset))
+        rows = cur.fetchall()
+    return jsonify(rows)
 
 
 @app.get("/api/config/proximity")
@@ -534,11 +862,17 @@ if __name__ == "__main__":
     #     print("  ", row["porter_id"], row["name"])
 
     # ✅ อ่านจาก SQLite ตรงๆ
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT porter_id, name FROM porters ORDER BY porter_id")
-    for row in cur.fetchall():
-        print("  ", row["porter_id"], row["name"])
-    conn.close()
+    with get_read_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT porter_id, name FROM porters ORDER BY porter_id")
+        for row in cur.fetchall():
+            print("  ", row["porter_id"], row["name"])
 
     print("\nTry (another shell) → python demo_client.py")
-    app.run(host="0.0.0.0", port=APP_PORT, debug=False)
+    try:
+        from waitress import serve
+    except ImportError:
+        print("waitress not installed → Flask threaded dev server")
+        app.run(host="0.0.0.0", port=APP_PORT, debug=False, threaded=True)
+    else:
+        serve(app, host="0.0.0.0", port=APP_PORT, threads=APP_THREADS)